@@ -0,0 +1,14 @@
+"""Project environment checks for CLI entrypoints.
+
+emorep_env_active : whether the emorep environment is on sys.path
+
+"""
+
+import sys
+import functools
+
+
+@functools.lru_cache(maxsize=1)
+def emorep_env_active() -> bool:
+    """Check whether the emorep project environment is active."""
+    return any("emorep" in path for path in sys.path)
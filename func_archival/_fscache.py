@@ -0,0 +1,90 @@
+"""Cached filesystem checks for hot submission paths.
+
+cached_stat : process-lifetime cached os.stat
+has_match : TTL-cached directory scan for a file name suffix
+
+Checks against NFS-mounted project directories cost a network
+round-trip per syscall. has_match caches scan results for ~1s, so
+repeated probes within a submission batch hit memory while still
+observing recent filesystem changes. cached_stat instead holds
+successful stat results for the process lifetime and never sees
+later changes; reserve it for paths that are stable once validated
+and use clear_stat_cache when they are not.
+
+"""
+
+import os
+import time
+from functools import lru_cache
+
+
+# Successful stat results, held for the process lifetime
+_STAT_CACHE = {}
+
+
+def cached_stat(path):
+    """Return os.stat result, cached for the process lifetime.
+
+    Intended for paths validated repeatedly in batch runs that
+    are not expected to change mid-process, e.g. project and
+    raw-data directories. Failed stats are not cached.
+
+    Parameters
+    ----------
+    path : str, os.PathLike
+        Location to stat
+
+    Returns
+    -------
+    os.stat_result
+
+    """
+    path = str(path)
+    path_stat = _STAT_CACHE.get(path)
+    if path_stat is None:
+        path_stat = os.stat(path)
+        _STAT_CACHE[path] = path_stat
+    return path_stat
+
+
+def clear_stat_cache():
+    """Drop all cached stat results."""
+    _STAT_CACHE.clear()
+
+
+@lru_cache(maxsize=1024)
+def _match(path: str, suffix: str, bucket: int) -> bool:
+    """Scan directory for suffix, bucketed by second for TTL expiry.
+
+    Returns on the first matching entry name. Only dirent names
+    are read, so no per-file stat follows the directory read.
+
+    """
+    try:
+        with os.scandir(path) as scan_it:
+            for entry in scan_it:
+                if entry.name.endswith(suffix):
+                    return True
+    except FileNotFoundError:
+        return False
+    return False
+
+
+def has_match(path, suffix: str) -> bool:
+    """Check directory for a file name ending in suffix.
+
+    Results are cached with ~1s TTL.
+
+    Parameters
+    ----------
+    path : str, os.PathLike
+        Location of directory to scan
+    suffix : str
+        File name ending to match
+
+    Returns
+    -------
+    bool
+
+    """
+    return _match(str(path), suffix, int(time.monotonic()))
@@ -14,15 +14,77 @@ func_archival \
 
 # %%
 import os
+import re
 import sys
 import time
 import textwrap
+import threading
+import functools
+import collections
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from argparse import ArgumentParser, RawTextHelpFormatter
 from func_archival import submit
+from func_archival import workflows
+from func_archival import _env
+from func_archival import _fscache
 import func_archival._version as ver
 
 
+# Dedent help strings once at import, not per _get_args call
+_HELP_IGNORE_FMAPS = textwrap.dedent(
+    """\
+    Whether fmriprep will ignore fmaps,
+    True if "--ignore-fmaps" else False.
+    """
+)
+_HELP_FD_THRESH = textwrap.dedent(
+    """\
+    Framewise displacement threshold
+    (default : %(default)s)
+    """
+)
+_HELP_ARRAY = textwrap.dedent(
+    """\
+    Schedule all subjects as a single SLURM job array
+    via one sbatch call, rather than one job per subject,
+    True if "--array" else False.
+    """
+)
+_HELP_ARRAY_THROTTLE = textwrap.dedent(
+    """\
+    Maximum number of simultaneously running array tasks,
+    used with "--array"
+    (default : %(default)s)
+    """
+)
+_HELP_SUBMIT_RATE = textwrap.dedent(
+    """\
+    Scheduler submission rate, as tokens/period
+    e.g. 1/3s, 50/min
+    (default : %(default)s)
+    """
+)
+_HELP_SESSIONS = textwrap.dedent(
+    """\
+    List of BIDS session identifiers
+    (default : %(default)s)
+    """
+)
+_HELP_PREPROC_TYPE = textwrap.dedent(
+    """\
+    Determine whether to use scaled or smoothed preprocessed EPIs
+    (default : %(default)s)
+    """
+)
+_HELP_PROJ_DIR = textwrap.dedent(
+    """\
+    Path to BIDS-formatted project directory
+    (default : %(default)s)
+    """
+)
+
+
 # %%
 def _get_args():
     """Get and parse arguments."""
@@ -30,61 +92,53 @@ def _get_args():
     parser = ArgumentParser(
         description=ver_info + __doc__, formatter_class=RawTextHelpFormatter
     )
+    parser.add_argument(
+        "--array",
+        action="store_true",
+        help=_HELP_ARRAY,
+    )
+    parser.add_argument(
+        "--array-throttle",
+        type=int,
+        default=20,
+        help=_HELP_ARRAY_THROTTLE,
+    )
     parser.add_argument(
         "--ignore-fmaps",
         action="store_true",
-        help=textwrap.dedent(
-            """\
-            Whether fmriprep will ignore fmaps,
-            True if "--ignore-fmaps" else False.
-            """
-        ),
+        help=_HELP_IGNORE_FMAPS,
     )
     parser.add_argument(
         "--fd-thresh",
         type=float,
         default=0.5,
-        help=textwrap.dedent(
-            """\
-            Framewise displacement threshold
-            (default : %(default)s)
-            """
-        ),
+        help=_HELP_FD_THRESH,
+    )
+    parser.add_argument(
+        "--submit-rate",
+        type=str,
+        default="1/3s",
+        help=_HELP_SUBMIT_RATE,
     )
     parser.add_argument(
         "--sessions",
         nargs="+",
         default=["ses-BAS1"],
         choices=["ses-BAS1"],
-        help=textwrap.dedent(
-            """\
-            List of BIDS session identifiers
-            (default : %(default)s)
-            """
-        ),
+        help=_HELP_SESSIONS,
     )
     parser.add_argument(
         "--preproc-type",
         type=str,
         default="scaled",
         choices=["scaled", "smoothed"],
-        help=textwrap.dedent(
-            """\
-            Determine whether to use scaled or smoothed preprocessed EPIs
-            (default : %(default)s)
-            """
-        ),
+        help=_HELP_PREPROC_TYPE,
     )
     parser.add_argument(
         "--proj-dir",
         type=str,
         default="/hpc/group/labarlab/EmoRep/Exp3_Classify_Archival/data_mri_BIDS",  # noqa: E501
-        help=textwrap.dedent(
-            """\
-            Path to BIDS-formatted project directory
-            (default : %(default)s)
-            """
-        ),
+        help=_HELP_PROJ_DIR,
     )
 
     required_args = parser.add_argument_group("Required Arguments")
@@ -104,6 +158,83 @@ def _get_args():
     return parser
 
 
+# %%
+@functools.lru_cache(maxsize=1)
+def _load_user() -> str:
+    """Return cached USER environment variable."""
+    try:
+        return os.environ["USER"]
+    except KeyError:
+        raise EnvironmentError(
+            "Missing required environment variable : USER"
+        )
+
+
+def _parse_rate(submit_rate: str) -> tuple:
+    """Parse tokens/period syntax into (tokens, period seconds)."""
+    unit_secs = {"s": 1, "sec": 1, "m": 60, "min": 60, "h": 3600, "hr": 3600}
+    try:
+        tokens, period = submit_rate.split("/")
+        num, unit = re.match(
+            r"(\d*)\s*([a-z]+)$", period.strip()
+        ).groups()
+        period_sec = (int(num) if num else 1) * unit_secs[unit]
+        num_tok = int(tokens)
+        if num_tok < 1:
+            raise ValueError
+        return (num_tok, period_sec)
+    except (ValueError, AttributeError, KeyError):
+        raise ValueError(
+            f"Unable to parse submission rate : {submit_rate}"
+        )
+
+
+class _RateLimiter:
+    """Token-bucket limiter for scheduler submissions.
+
+    Only sleeps when more than <tokens> submissions would
+    occur within <period> seconds. Safe to share across
+    submission threads.
+
+    """
+
+    def __init__(self, tokens: int, period: float):
+        self._period = period
+        self._last_times = collections.deque(maxlen=tokens)
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until a submission token is available."""
+        with self._lock:
+            now = time.monotonic()
+            if (
+                len(self._last_times) == self._last_times.maxlen
+                and now - self._last_times[0] < self._period
+            ):
+                time.sleep(self._period - (now - self._last_times[0]))
+            self._last_times.append(time.monotonic())
+
+
+def _submit_one(
+    subj,
+    sess_list,
+    proj_dir,
+    work_dir,
+    log_dir,
+    preproc_args,
+    model_args,
+    limiter,
+    preproc_done,
+):
+    """Build and submit workflow script for a single subject."""
+    sched_wf = submit.ScheduleWorkflow(
+        subj, sess_list, proj_dir, work_dir, log_dir
+    )
+    sched_wf.run_all(preproc_args, model_args, preproc_done=preproc_done)
+    limiter.wait()
+    sched_wf.submit()
+
+
 # %%
 def main():
     """Setup working environment."""
@@ -111,22 +242,24 @@ def main():
     # Capture CLI arguments
     args = _get_args().parse_args()
     subj_list = args.subj_list
+    if not subj_list:
+        return
     sess_list = args.sessions
     proj_dir = args.proj_dir
     ignore_fmaps = args.ignore_fmaps
     fd_thresh = args.fd_thresh
     preproc_type = args.preproc_type
+    rate_tokens, rate_period = _parse_rate(args.submit_rate)
 
     # Setup work, log directories
-    work_dir = os.path.join("/work", os.environ["USER"], "Archival")
+    work_dir = os.path.join("/work", _load_user(), "Archival")
     now_time = datetime.now().strftime("%y%m%d_%H%M")
     log_dir = os.path.join(
         work_dir,
         "logs",
         f"func_archival_{now_time}",
     )
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
+    os.makedirs(log_dir, exist_ok=True)
 
     # Build pipeline-step arguments
     preproc_args = {
@@ -138,22 +271,73 @@ def main():
         "model_level": "first",
         "preproc_type": preproc_type,
     }
+    workflows.validate_args(preproc_args, model_args)
 
-    # Submit workflows
+    # Pre-flight check for existing preprocessed output by session,
+    # so each scheduled job skips the directory scan on the compute
+    # node
+    pp_done = {}
     for subj in subj_list:
-        sched_wf = submit.ScheduleWorkflow(
-            subj, sess_list, proj_dir, work_dir, log_dir
+        pp_done[subj] = {}
+        for sess in sess_list:
+            chk_path = os.path.join(
+                proj_dir,
+                "derivatives",
+                "pre_processing",
+                "fsl_denoise",
+                subj,
+                sess,
+                "func",
+            )
+            pp_done[subj][sess] = _fscache.has_match(
+                chk_path, "scaled_bold.nii.gz"
+            )
+
+    # Schedule all subjects via one job-array submission
+    if args.array:
+        arr_script = submit.ScheduleWorkflow.build_array_script(
+            subj_list,
+            sess_list,
+            proj_dir,
+            work_dir,
+            log_dir,
+            preproc_args,
+            model_args,
+            preproc_done=pp_done,
+        )
+        submit.submit_array(
+            arr_script, len(subj_list), max_concurrent=args.array_throttle
         )
-        sched_wf.run_all(preproc_args, model_args)
-        sched_wf.submit()
-        time.sleep(3)
+        return
+
+    # Submit workflows concurrently, throttled by submission rate
+    limiter = _RateLimiter(rate_tokens, rate_period)
+    with ThreadPoolExecutor(
+        max_workers=min(8, len(subj_list))
+    ) as exc:
+        future_subj = {
+            exc.submit(
+                _submit_one,
+                subj,
+                sess_list,
+                proj_dir,
+                work_dir,
+                log_dir,
+                preproc_args,
+                model_args,
+                limiter,
+                pp_done[subj],
+            ): subj
+            for subj in subj_list
+        }
+        for future in as_completed(future_subj):
+            future.result()
 
 
 if __name__ == "__main__":
 
     # Require proj env
-    env_found = [x for x in sys.path if "emorep" in x]
-    if not env_found:
+    if not _env.emorep_env_active():
         print("\nERROR: missing required project environment 'emorep'.")
         print("\tHint: $labar_env emorep\n")
         sys.exit(1)
@@ -1,13 +1,60 @@
 """Methods for submitting BASH commands to subprocess or SLURM scheduler.
 
 ScheduleWorkflow : generate and submit python workflow script
+submit_array : submit workflow script as SLURM job array
 
 """
 
 import os
 import sys
+import json
 import textwrap
+import py_compile
 import subprocess
+from functools import cached_property
+
+
+def _write_py(py_script, wf_cmd):
+    """Write workflow command to script, validate via byte-compile."""
+    fd = os.open(
+        py_script,
+        os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+        0o644,
+    )
+    try:
+        os.write(fd, wf_cmd.encode())
+    finally:
+        os.close(fd)
+    py_compile.compile(py_script, doraise=True)
+
+
+def submit_array(py_script, num_tasks, max_concurrent=None):
+    """Submit workflow script as SBATCH job array.
+
+    Parameters
+    ----------
+    py_script : str, os.PathLike
+        Location of array workflow script
+    num_tasks : int
+        Number of array tasks (subjects)
+    max_concurrent : int, optional
+        Limit on simultaneously running array tasks,
+        applied as sbatch's %N throttle
+
+    """
+    array_spec = f"0-{num_tasks - 1}"
+    if max_concurrent:
+        array_spec += f"%{max_concurrent}"
+    sp_job = subprocess.run(
+        ["sbatch", f"--array={array_spec}", py_script],
+        capture_output=True,
+    )
+    if sp_job.returncode != 0:
+        raise RuntimeError(
+            f"sbatch failed for array {py_script}: "
+            f"{sp_job.stderr.decode('utf-8').strip()}"
+        )
+    print(f"{sp_job.stdout.decode('utf-8')}\tfor {num_tasks} tasks")
 
 
 class ScheduleWorkflow:
@@ -28,6 +75,8 @@ class ScheduleWorkflow:
         Generate omnibus workflow script
     submit()
         Submit workflow script as SBATCH job
+    build_array_script(*args)
+        Generate single job-array script for many subjects
 
     Example
     -------
@@ -62,17 +111,19 @@ class ScheduleWorkflow:
 
         """
         self._subj = subj
+        self._subj_short = subj[-4:]
         self._sess_list = sess_list
         self._proj_dir = proj_dir
         self._work_dir = work_dir
         self._log_dir = log_dir
 
+    @cached_property
     def _sbatch_head(self) -> str:
-        """Return sbatch preamble."""
+        """Return sbatch preamble, built once per instance."""
         return f"""\
             #!/bin/env {sys.executable}
-            #SBATCH --job-name=p{self._subj[-4:]}
-            #SBATCH --output={self._log_dir}/par{self._subj[-4:]}.txt
+            #SBATCH --job-name=p{self._subj_short}
+            #SBATCH --output={self._log_dir}/par{self._subj_short}.txt
             #SBATCH --time=40:00:00
             #SBATCH --cpus-per-task=3
             #SBATCH --mem-per-cpu=4G
@@ -83,15 +134,16 @@ class ScheduleWorkflow:
         self.py_script = os.path.join(
             self._log_dir, f"run_{wf_name}_{self._subj}.py"
         )
-        with open(self.py_script, "w") as ps:
-            ps.write(wf_cmd)
+        _write_py(self.py_script, wf_cmd)
 
-    def run_all(self, preproc_args, model_args):
+    def run_all(self, preproc_args, model_args, preproc_done=None):
         """Write preprocess workflow script.
 
         Make a workflow call for a single session of a subject.
         Saves script to:
             <log_dir>/run_omnibus_<subj>.py
+        and workflow arguments to:
+            <log_dir>/args_omnibus_<subj>.json
 
         Parameters
         ----------
@@ -101,33 +153,143 @@ class ScheduleWorkflow:
         model_args : dict
             Same as preproc_args, but for modeling portion of
             preproc_model
+        preproc_done : dict, optional
+            Pre-flight results mapping session -> bool for
+            existing preprocessed output, embedded in the script
+            to spare the compute node a directory scan
 
         """
-        py_cmd = f"""{self._sbatch_head()}
+        args_json = os.path.join(
+            self._log_dir, f"args_omnibus_{self._subj}.json"
+        )
+        with open(args_json, "w") as jf:
+            json.dump({"preproc": preproc_args, "model": model_args}, jf)
+
+        py_cmd = f"""{self._sbatch_head}
+            import json
             from func_archival import workflows
+
+            with open("{args_json}") as jf:
+                wf_args = json.load(jf)
             workflows.preproc_model(
                 "{self._subj}",
                 {self._sess_list},
                 "{self._proj_dir}",
                 "{self._work_dir}",
                 "{self._log_dir}",
-                {preproc_args},
-                {model_args},
+                wf_args["preproc"],
+                wf_args["model"],
+                preproc_done={preproc_done},
             )
         """
         sbatch_cmd = textwrap.dedent(py_cmd)
         self._write_script("omnibus", sbatch_cmd)
 
+    @classmethod
+    def build_array_script(
+        cls,
+        subj_list,
+        sess_list,
+        proj_dir,
+        work_dir,
+        log_dir,
+        preproc_args,
+        model_args,
+        preproc_done=None,
+    ):
+        """Write single job-array workflow script for all subjects.
+
+        Each array task indexes the subject list via
+        SLURM_ARRAY_TASK_ID, so one sbatch call schedules
+        every subject. Saves script to:
+            <log_dir>/run_omnibus_array.py
+        and workflow arguments to:
+            <log_dir>/args_omnibus_array.json
+
+        Parameters
+        ----------
+        subj_list : list
+            BIDS subjects
+        sess_list : list
+            BIDS session identifiers
+        proj_dir : str, os.PathLike
+            Location of project directory
+        work_dir : str, os.PathLike
+            Location of working directory, for intermediates
+        log_dir : str, os.PathLike
+            Output location for capturing stdout/err
+        preproc_args : dict
+            Argument and parameter specific for preprocessing
+            portion of preproc_model
+        model_args : dict
+            Same as preproc_args, but for modeling portion of
+            preproc_model
+        preproc_done : dict, optional
+            Pre-flight results mapping subject -> {session: bool}
+            for existing preprocessed output
+
+        Returns
+        -------
+        str, os.PathLike
+            Location of array workflow script
+
+        """
+        args_json = os.path.join(log_dir, "args_omnibus_array.json")
+        with open(args_json, "w") as jf:
+            json.dump(
+                {
+                    "subjects": list(subj_list),
+                    "sessions": list(sess_list),
+                    "preproc": preproc_args,
+                    "model": model_args,
+                    "preproc_done": preproc_done or {},
+                },
+                jf,
+            )
+
+        py_cmd = f"""\
+            #!/bin/env {sys.executable}
+            #SBATCH --job-name=parr
+            #SBATCH --output={log_dir}/parr_%a_%A.txt
+            #SBATCH --time=40:00:00
+            #SBATCH --cpus-per-task=3
+            #SBATCH --mem-per-cpu=4G
+
+            import os
+            import json
+            from func_archival import workflows
+
+            with open("{args_json}") as jf:
+                cfg = json.load(jf)
+            subj = cfg["subjects"][int(os.environ["SLURM_ARRAY_TASK_ID"])]
+            workflows.preproc_model(
+                subj,
+                cfg["sessions"],
+                "{proj_dir}",
+                "{work_dir}",
+                "{log_dir}",
+                cfg["preproc"],
+                cfg["model"],
+                preproc_done=cfg["preproc_done"].get(subj),
+            )
+        """
+        py_script = os.path.join(log_dir, "run_omnibus_array.py")
+        _write_py(py_script, textwrap.dedent(py_cmd))
+        return py_script
+
     def submit(self):
         """Submit python script to SLURM scheduler."""
         if not hasattr(self, "py_script"):
             raise AttributeError(
                 "Please generate workflow script before envoking submit."
             )
-        sp_job = subprocess.Popen(
-            f"sbatch {self.py_script}",
-            shell=True,
-            stdout=subprocess.PIPE,
+        sp_job = subprocess.run(
+            ["sbatch", self.py_script],
+            capture_output=True,
         )
-        sp_out, _ = sp_job.communicate()
-        print(f"{sp_out.decode('utf-8')}\tfor {self._subj}")
+        if sp_job.returncode != 0:
+            raise RuntimeError(
+                f"sbatch failed for {self._subj}: "
+                f"{sp_job.stderr.decode('utf-8').strip()}"
+            )
+        print(f"{sp_job.stdout.decode('utf-8')}\tfor {self._subj}")
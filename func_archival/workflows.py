@@ -1,6 +1,8 @@
 """Workflows for managing data pipeline.
 
 preproc_model : Preprocess and model resting EPI data
+preproc_model_many : Run preproc_model for many subjects concurrently
+validate_args : Check required workflow argument keys
 
 Notes
 -----
@@ -12,9 +14,154 @@ EmoRep dependencies:
 
 # %%
 import os
-import glob
-from func_preprocess import workflows as wf_fp
-from func_model.workflows import wf_fsl
+import json
+import stat
+import time
+import hashlib
+from pathlib import Path
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from func_archival import _fscache
+
+
+# Required workflow argument keys
+_PREPROC_KEYS = frozenset({"fd_thresh", "ignore_fmaps"})
+_MODEL_KEYS = frozenset({"model_name", "model_level", "preproc_type"})
+
+# Location of project directory on Keoki
+_KEOKI_PATH = (
+    "/mnt/keoki/experiments2/EmoRep/Exp3_Classify_Archival/data_mri_BIDS"
+)
+
+
+# %%
+def validate_args(preproc_args, model_args):
+    """Check required workflow argument keys.
+
+    Cheap to call before any heavy pipeline import, so argument
+    mistakes surface at submission rather than on the compute
+    node.
+
+    Parameters
+    ----------
+    preproc_args : dict
+        Argument and parameters specific for preprocess method
+    model_args : dict
+        Argument and parameters specific for modeling method
+
+    Raises
+    ------
+    KeyError
+        Missing required keys, all reported at once
+
+    """
+    missing = _PREPROC_KEYS - preproc_args.keys()
+    if missing:
+        raise KeyError(f"Missing preproc_args keys: {sorted(missing)}")
+    missing = _MODEL_KEYS - model_args.keys()
+    if missing:
+        raise KeyError(f"Missing model_args keys: {sorted(missing)}")
+
+
+def _require(path, kind):
+    """Validate path as existing dir or file with a single stat."""
+    try:
+        path_stat = _fscache.cached_stat(path)
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Missing {kind}: {path}")
+    if kind == "dir" and not stat.S_ISDIR(path_stat.st_mode):
+        raise NotADirectoryError(f"Expected directory: {path}")
+    if kind == "file" and not stat.S_ISREG(path_stat.st_mode):
+        raise IsADirectoryError(f"Expected file: {path}")
+
+
+def _inputs_hash(subj, proj_raw, preproc_args):
+    """Hash raw input listing and preprocess parameters."""
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps(preproc_args, sort_keys=True).encode())
+    for root, dirs, files in os.walk(Path(proj_raw) / subj):
+        dirs.sort()
+        for name in sorted(files):
+            file_stat = os.stat(os.path.join(root, name))
+            hasher.update(
+                f"{name}:{file_stat.st_size}:"
+                f"{int(file_stat.st_mtime)}".encode()
+            )
+    return hasher.hexdigest()
+
+
+def _args_hash(preproc_args, model_args):
+    """Hash workflow parameters for checkpoint keying."""
+    return hashlib.sha256(
+        json.dumps(
+            {"preproc": preproc_args, "model": model_args}, sort_keys=True
+        ).encode()
+    ).hexdigest()
+
+
+def _load_state(state_path, args_hash):
+    """Return completed stage set recorded for matching parameters.
+
+    A checkpoint recorded under different workflow arguments is
+    ignored, so changed parameters rerun their stages.
+
+    """
+    try:
+        with open(state_path) as jf:
+            state = json.load(jf)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return set()
+    if state.get("args_hash") != args_hash:
+        return set()
+    return set(state.get("stages", []))
+
+
+def _save_state(state_path, stages, args_hash):
+    """Atomically persist completed workflow stages."""
+    tmp_path = f"{state_path}.tmp"
+    with open(tmp_path, "w") as jf:
+        json.dump(
+            {
+                "stages": sorted(stages),
+                "args_hash": args_hash,
+                "ts": time.time(),
+            },
+            jf,
+        )
+    os.replace(tmp_path, state_path)
+
+
+def _sessions_done(subj, proj_pp):
+    """Return session IDs with existing scaled EPI output.
+
+    A single walk of the subject's fsl_denoise tree covers
+    all sessions, rather than one directory probe per session.
+
+    """
+    done = set()
+    subj_pp = Path(proj_pp) / "fsl_denoise" / subj
+    for root, _, files in os.walk(subj_pp):
+        if os.path.basename(root) != "func":
+            continue
+        if any(f.endswith("scaled_bold.nii.gz") for f in files):
+            done.add(os.path.basename(os.path.dirname(root)))
+    return done
+
+
+def _manifest_current(manifest_path, inputs_hash):
+    """Check recorded preprocess manifest against current inputs.
+
+    A missing or unreadable manifest passes, as existing output
+    predates manifest tracking; a recorded hash differing from
+    the current inputs fails.
+
+    """
+    try:
+        with open(manifest_path) as jf:
+            manifest = json.load(jf)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return True
+    return manifest.get("inputs_hash") == inputs_hash
 
 
 # %%
@@ -26,6 +173,7 @@ def preproc_model(
     log_dir,
     preproc_args,
     model_args,
+    preproc_done=None,
 ):
     """Preprocess and model archival resting-state data.
 
@@ -58,6 +206,12 @@ def preproc_model(
         -   ["model_name"] = name of FSL model
         -   ["model_level"] = level of FSL model
         -   ["preproc_type"] = preprocessing step used
+    preproc_done : bool or dict, optional
+        Whether preprocessed output already exists, determined
+        by a pre-flight check on the submission node. A dict
+        maps each session to its own result, a bool covers all
+        requested sessions. When None the output directory is
+        scanned here instead.
 
     Raises
     ------
@@ -65,59 +219,136 @@ def preproc_model(
         Missing required keys in preproc_args or model_args
 
     """
-    # Check for required keys
-    preproc_keys = [
-        "fd_thresh",
-        "ignore_fmaps",
-    ]
-    for chk_key in preproc_keys:
-        if chk_key not in preproc_args.keys():
-            raise KeyError(f"Expected key {chk_key} in preproc_args")
-    model_keys = [
-        "model_name",
-        "model_level",
-        "preproc_type",
-    ]
-    for chk_key in model_keys:
-        if chk_key not in model_args.keys():
-            raise KeyError(f"Expected key {chk_key} in model_args")
+    # Check for required keys, reporting all missing at once
+    validate_args(preproc_args, model_args)
+
+    # Defer heavy pipeline imports until arguments validate
+    from func_preprocess import workflows as wf_fp
+    from func_model.workflows import wf_fsl
 
     # Setup reference and final directories
-    proj_raw = os.path.join(proj_dir, "rawdata")
-    proj_deriv = os.path.join(proj_dir, "derivatives")
-    proj_pp = os.path.join(proj_deriv, "pre_processing")
-    keoki_path = (
-        "/mnt/keoki/experiments2/EmoRep/Exp3_Classify_Archival/data_mri_BIDS"
-    )
+    proj_dir = Path(proj_dir)
+    proj_raw = proj_dir / "rawdata"
+    proj_deriv = proj_dir / "derivatives"
+    proj_pp = proj_deriv / "pre_processing"
+    _require(proj_raw, "dir")
+
+    # Resume from checkpoint recorded for these arguments
+    state_path = Path(work_dir) / f"{subj}.state.json"
+    args_hash = _args_hash(preproc_args, model_args)
+    stages = _load_state(state_path, args_hash)
 
-    # Trigger workflows
-    chk_path = os.path.join(proj_pp, "fsl_denoise", subj, sess_list[0], "func")
-    chk_scale = glob.glob(f"{chk_path}/*scaled_bold.nii.gz")
-    if not chk_scale:
+    # Find sessions lacking preprocessed output, preferring the
+    # per-session pre-flight results when provided
+    if preproc_done is None:
+        sess_done = _sessions_done(subj, proj_pp)
+        sess_missing = [s for s in sess_list if s not in sess_done]
+    elif isinstance(preproc_done, dict):
+        sess_missing = [s for s in sess_list if not preproc_done.get(s)]
+    else:
+        sess_missing = [] if preproc_done else list(sess_list)
+
+    # Trust the checkpoint only while output evidence agrees;
+    # deleted derivatives force both stages to rerun
+    if sess_missing:
+        stages.clear()
+
+    # Invalidate existing output and checkpoint when raw inputs
+    # or parameters changed since the recorded preprocess run
+    manifest_path = proj_pp / f".manifest_{subj}.json"
+    inputs_hash = _inputs_hash(subj, proj_raw, preproc_args)
+    if not sess_missing and not _manifest_current(
+        manifest_path, inputs_hash
+    ):
+        sess_missing = list(sess_list)
+        stages.clear()
+
+    if sess_missing:
         wf_fp.run_preproc(
             subj,
-            sess_list,
+            sess_missing,
             proj_raw,
             proj_pp,
             work_dir,
             preproc_args["fd_thresh"],
             preproc_args["ignore_fmaps"],
             log_dir,
-            keoki_path=keoki_path,
+            keoki_path=_KEOKI_PATH,
+        )
+        with open(manifest_path, "w") as jf:
+            json.dump({"inputs_hash": inputs_hash}, jf)
+
+    if "model" not in stages:
+        wf_obj = wf_fsl.FslFirst(
+            subj,
+            sess_list[0],
+            model_args["model_name"],
+            model_args["preproc_type"],
+            proj_raw,
+            proj_deriv,
+            work_dir,
+            log_dir,
+            keoki_path=_KEOKI_PATH,
         )
+        wf_obj.model_rest()
+        stages.add("model")
+        _save_state(state_path, stages, args_hash)
+
 
-    wf_obj = wf_fsl.FslFirst(
-        subj,
-        sess_list[0],
-        model_args["model_name"],
-        model_args["preproc_type"],
-        proj_raw,
-        proj_deriv,
-        work_dir,
-        log_dir,
-        keoki_path=keoki_path,
+# %%
+def preproc_model_many(
+    subj_list,
+    sess_list,
+    proj_dir,
+    work_dir,
+    log_dir,
+    preproc_args,
+    model_args,
+    n_jobs=4,
+):
+    """Run preproc_model for multiple subjects concurrently.
+
+    Fan independent subjects out across a process pool, for
+    running a batch within a single large allocation rather
+    than scheduling one job per subject.
+
+    Parameters
+    ----------
+    subj_list : list
+        BIDS subjects
+    sess_list : list
+        BIDS session identifiers
+    proj_dir : str, os.PathLike
+        Location of project directory
+    work_dir : str, os.PathLike
+        Location of working directory, for intermediates
+    log_dir : str, os.PathLike
+        Output location for capturing stdout/err
+    preproc_args : dict
+        Argument and parameters specific for preprocess method,
+        see preproc_model
+    model_args : dict
+        Argument and parameters specific for modeling method,
+        see preproc_model
+    n_jobs : int, optional
+        Number of concurrent subject workflows
+
+    """
+    if not subj_list:
+        return
+    run_one = partial(
+        preproc_model,
+        sess_list=sess_list,
+        proj_dir=proj_dir,
+        work_dir=work_dir,
+        log_dir=log_dir,
+        preproc_args=preproc_args,
+        model_args=model_args,
     )
-    wf_obj.model_rest()
+    with ProcessPoolExecutor(
+        max_workers=min(n_jobs, len(subj_list))
+    ) as exc:
+        list(exc.map(run_one, subj_list))
 
 
 # %%
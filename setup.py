@@ -1,10 +1,14 @@
+import re
 from setuptools import setup, find_packages
 
-exec(open("func_archival/_version.py").read())
+with open("func_archival/_version.py") as vf:
+    __version__ = re.search(
+        r'__version__\s*=\s*"([^"]+)"', vf.read()
+    ).group(1)
 
 setup(
     name="func_archival",
-    version=__version__,  # noqa: F821
+    version=__version__,
     packages=find_packages(),
     entry_points={
         "console_scripts": [